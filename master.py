@@ -1,65 +1,219 @@
+from __future__ import annotations
+
 import asyncio
 import datetime
-import json
 import logging
 import os
+import queue
+from dataclasses import dataclass, fields
+from logging.handlers import QueueHandler, QueueListener
 
 import discord
-import pytz
+import orjson
 from discord.ext import commands
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 load_dotenv("token.env")
 
 
+@dataclass(frozen=True)
+class Config:
+    """
+    The bot configuration loaded from config.json.
+    """
+
+    admin_role_id: int
+    old_role_id: int
+    new_role_id: int
+    channel_id: int
+    join_time_threshold: int
+    timezone: str
+    prefix: str
+    log_file: str
+
+
 def read_config():
     """
     Reads the configuration from a JSON file.
 
     Returns:
-        dict: The configuration as a dictionary.
+        Config: The configuration.
     Raises:
         FileNotFoundError: If the config.json file does not exist.
     """
     try:
-        with open("config.json") as f:
-            return json.load(f)
+        with open("config.json", "rb") as f:
+            data = orjson.loads(f.read())
     except FileNotFoundError as e:
         logging.error(f"Failed to read configuration file: {e}")
         raise
+    names = {field.name for field in fields(Config)}
+    return Config(
+        **{key.lower(): value for key, value in data.items() if key.lower() in names}
+    )
 
 
 config = read_config()
 
 TOKEN = os.getenv("TOKEN")
-ADMIN_ROLE_ID = config["ADMIN_ROLE_ID"]
-OLD_ROLE_ID = config["OLD_ROLE_ID"]
-NEW_ROLE_ID = config["NEW_ROLE_ID"]
-CHANNEL_ID = config["CHANNEL_ID"]
-JOIN_TIME_THRESHOLD = config["JOIN_TIME_THRESHOLD"]
-TIMEZONE = config["TIMEZONE"]
-PREFIX = config["PREFIX"]
-LOG_FILE = config["LOG_FILE"]
 
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO)
+CONGRATULATION_MESSAGE = (
+    "{mention}, поздравляю с новым титулом! Теперь ты житель. Живи во благо Рэйвенхолда!"
+)
+
+log_queue = queue.SimpleQueue()
+log_handler = logging.FileHandler(config.log_file)
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+# Like bot.run, show only discord.py's own records on the console.
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(
+    logging.Formatter(
+        "[{asctime}] [{levelname:<8}] {name}: {message}", "%Y-%m-%d %H:%M:%S", style="{"
+    )
+)
+console_handler.addFilter(logging.Filter("discord"))
+log_listener = QueueListener(log_queue, log_handler, console_handler)
+log_listener.start()
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+
+intents = discord.Intents(
+    guilds=True, members=True, guild_messages=True, message_content=True
+)
+
+bot = commands.Bot(
+    command_prefix=config.prefix,
+    intents=intents,
+    case_insensitive=True,
+    member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+    chunk_guilds_at_startup=False,
+)
+
+CHANNEL_SEM = asyncio.Semaphore(5)
+SEND_WINDOW = 5.0
+MAX_SEND_RETRIES = 3
+
+OLD_ROLE_MEMBERS: set[int] = set()
+
+_role_cache: dict[tuple[int, int], discord.Role] = {}
+_inflight: dict[int, asyncio.Task] = {}
+_command_lock = asyncio.Lock()
+_channel = None
+
+
+def get_cached_role(guild, role_id):
+    """
+    Get a role from the guild, caching the resolved object.
+
+    Args:
+        guild (discord.Guild): The guild the role belongs to.
+        role_id (int): The ID of the role.
+
+    Returns:
+        Optional[discord.Role]: The role, or None if it does not exist.
+    """
+    key = (guild.id, role_id)
+    role = _role_cache.get(key)
+    if role is None:
+        role = guild.get_role(role_id)
+        if role:
+            _role_cache[key] = role
+    return role
+
 
-intents = discord.Intents.all()
+def get_cached_channel():
+    """
+    Get the channel for congratulatory messages, caching the resolved object.
 
-bot = commands.Bot(command_prefix=PREFIX, intents=intents)
+    Returns:
+        Optional[discord.abc.GuildChannel]: The channel, or None if it does not exist.
+    """
+    global _channel
+    if _channel is None:
+        _channel = bot.get_channel(config.channel_id)
+    return _channel
 
 
 async def get_members_with_old_role(guild):
     """
     Get members with the old role.
 
+    Members are looked up from OLD_ROLE_MEMBERS, which is kept up to date by
+    gateway events, so only the members holding the old role are visited
+    rather than the whole guild. IDs that no longer resolve to a member
+    holding the role are dropped from the set.
+
     Args:
         guild (discord.Guild): The guild to check for members with the old role.
 
     Returns:
         List[discord.Member]: A list of members with the old role.
     """
-    old_role = guild.get_role(OLD_ROLE_ID)
-    return old_role.members if old_role else []
+    members = []
+    stale = []
+    for uid in OLD_ROLE_MEMBERS:
+        member = guild.get_member(uid)
+        if member is not None and member.get_role(config.old_role_id) is not None:
+            members.append(member)
+        else:
+            stale.append(uid)
+    OLD_ROLE_MEMBERS.difference_update(stale)
+    return members
+
+
+def track_old_role(member):
+    """
+    Add or remove a member from the set of members holding the old role.
+
+    Members of guilds without the old role are ignored, so a user sharing
+    another guild with the bot is not dropped from the set.
+
+    Args:
+        member (discord.Member): The member whose roles should be tracked.
+    """
+    if get_cached_role(member.guild, config.old_role_id) is None:
+        return
+    if member.get_role(config.old_role_id) is not None:
+        OLD_ROLE_MEMBERS.add(member.id)
+    else:
+        OLD_ROLE_MEMBERS.discard(member.id)
+        _inflight.pop(member.id, None)
+
+
+async def rate_limited_send(channel, message):
+    """
+    Send a message to a Discord channel, keeping at most five sends per five seconds.
+
+    Each send holds one of five slots for SEND_WINDOW seconds, which matches
+    Discord's per-channel limit. discord.py already retries rate-limited
+    requests itself; if a 429 still gets through, the send is retried up to
+    MAX_SEND_RETRIES times after the Retry-After delay before giving up.
+
+    Args:
+        channel (discord.Channel): The channel to send the message to.
+        message (str): The message to send.
+
+    Raises:
+        discord.HTTPException: If the send fails or is still rate limited after all retries.
+    """
+    async with CHANNEL_SEM:
+        for attempt in range(MAX_SEND_RETRIES + 1):
+            try:
+                await channel.send(message)
+                break
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == MAX_SEND_RETRIES:
+                    raise
+                retry_after = float(e.response.headers.get("Retry-After", 1.0))
+                logging.info(f"Rate limited, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+        await asyncio.sleep(SEND_WINDOW)
 
 
 async def send_message(channel, message):
@@ -70,8 +224,7 @@ async def send_message(channel, message):
         channel (discord.Channel): The channel to send the message to.
         message (str): The message to send.
     """
-    await channel.send(message)
-    await asyncio.sleep(1)
+    await rate_limited_send(channel, message)
 
 
 async def send_messages(channel, messages):
@@ -86,10 +239,67 @@ async def send_messages(channel, messages):
     await asyncio.gather(*tasks)
 
 
+async def run_workers(items, job, workers=30, delay=3.33, maxsize=64):
+    """
+    Run a job for each item using a fixed pool of workers fed from a bounded queue.
+
+    Items are pulled from the iterable only as the queue has room, so at most
+    maxsize items and one job per worker are alive at a time. Each worker pauses
+    for delay seconds after a job, which keeps the overall request rate near
+    workers / delay per second. A failing job does not stop the run: the
+    remaining items are still processed and the failed items are returned
+    once the queue is empty. Jobs are expected to log their own errors.
+
+    Args:
+        items (Iterable): The items to process.
+        job (Callable[[Any], Awaitable]): The coroutine function to run for each item.
+        workers (int, optional): The number of concurrent workers. Defaults to 30.
+        delay (float, optional): The pause after each job in seconds. Defaults to 3.33.
+        maxsize (int, optional): The maximum number of queued items. Defaults to 64.
+
+    Returns:
+        Tuple[int, List]: The number of items taken from the iterable and the items whose job failed.
+    """
+    item_queue = asyncio.Queue(maxsize=maxsize)
+    failed = []
+    processed = 0
+
+    async def worker():
+        nonlocal processed
+        while (item := await item_queue.get()) is not None:
+            try:
+                await job(item)
+            except Exception:
+                failed.append(item)
+                continue
+            processed += 1
+            if processed % 1000 == 0:
+                logging.info(f"Processed {processed} items")
+            await asyncio.sleep(delay)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    count = 0
+    try:
+        for item in items:
+            await item_queue.put(item)
+            count += 1
+        for _ in tasks:
+            await item_queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if failed:
+        logging.error(f"Failed to process {len(failed)} of {count} items")
+    return count, failed
+
+
 async def change_role_and_send_message(member, old_role, new_role, channel):
     """
     Change a member's role and send them a congratulatory message.
 
+    The old role is swapped for the new one in a single member edit.
+
     Args:
         member (discord.Member): The member to change the role for.
         old_role (discord.Role): The old role to remove.
@@ -97,47 +307,82 @@ async def change_role_and_send_message(member, old_role, new_role, channel):
         channel (discord.Channel): The channel to send the congratulatory message to.
 
     Raises:
-        discord.Forbidden: If the bot does not have permission to change roles or send messages.
+        discord.HTTPException: If changing roles or sending the message fails,
+            e.g. discord.Forbidden when the bot lacks permission.
     """
     try:
-        await member.remove_roles(old_role)
-        await member.add_roles(new_role)
-        await channel.send(
-            f"{member.mention}, поздравляю с новым титулом! Теперь ты житель. Живи во благо Рэйвенхолда!"
+        new_roles = [r for r in member.roles[1:] if r != old_role] + [new_role]
+        await member.edit(roles=new_roles, reason="promotion")
+        await rate_limited_send(
+            channel, CONGRATULATION_MESSAGE.format(mention=member.mention)
+        )
+    except discord.HTTPException as e:
+        logging.error(
+            f"Error changing role and sending message for member {member.id}: {e}"
         )
-    except discord.Forbidden as e:
-        logging.error(f"Error changing role and sending message: {e}")
         raise
 
 
-def check_admin_role(ctx):
+def get_promotion_task(member, old_role, new_role, channel):
     """
-    Check if the command sender has the admin role.
+    Get the promotion task for a member, starting one if none is in flight.
+
+    Repeated commands reuse the running task instead of promoting the same
+    member twice. No task is started for a member who already has the new
+    role, since they may have been promoted after being queued.
 
     Args:
-        ctx (commands.Context): The context of the command.
+        member (discord.Member): The member to promote.
+        old_role (discord.Role): The old role to remove.
+        new_role (discord.Role): The new role to add.
+        channel (discord.Channel): The channel to send the congratulatory message to.
 
     Returns:
-        bool: True if the sender has the admin role, False otherwise.
+        Optional[asyncio.Task]: The task promoting the member, or None if they already have the new role.
     """
-    admin_role = ctx.guild.get_role(ADMIN_ROLE_ID)
-    return admin_role in ctx.author.roles if admin_role else False
+    task = _inflight.get(member.id)
+    if task is not None:
+        return task
+    if member.get_role(new_role.id) is None:
+        task = asyncio.create_task(
+            change_role_and_send_message(member, old_role, new_role, channel)
+        )
+        _inflight[member.id] = task
 
+        def forget(done_task, member_id=member.id):
+            # Successful tasks stay until the member cache shows the old role
+            # gone, so a run racing the member update event cannot promote twice.
+            failed = done_task.cancelled() or done_task.exception() is not None
+            if failed and _inflight.get(member_id) is done_task:
+                del _inflight[member_id]
 
-def check_join_time(member, threshold):
+        task.add_done_callback(forget)
+    return task
+
+
+def is_admin():
     """
-    Check if a member's join time exceeds a threshold.
+    Command check that the sender has the admin role.
 
-    Args:
-        member (discord.Member): The member to check.
-        threshold (int): The join time threshold in seconds.
+    The role is looked up by ID on the author's sorted role ID list, so no
+    role objects are built or scanned.
 
     Returns:
-        bool: True if the member's join time exceeds the threshold, False otherwise.
+        Callable: A check decorator for commands.
+
+    Raises:
+        commands.NoPrivateMessage: If the command is used outside a guild.
+        commands.MissingRole: If the sender does not have the admin role.
     """
-    join_time = member.joined_at.astimezone(pytz.timezone(TIMEZONE))
-    current_time = datetime.datetime.now(pytz.timezone(TIMEZONE))
-    return (current_time - join_time).total_seconds() > threshold
+
+    def predicate(ctx):
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        if ctx.author.get_role(config.admin_role_id) is None:
+            raise commands.MissingRole(config.admin_role_id)
+        return True
+
+    return commands.check(predicate)
 
 
 def check_roles_and_channel(ctx):
@@ -151,69 +396,88 @@ def check_roles_and_channel(ctx):
         bool: True if the roles and channel exist, False otherwise.
     """
     guild = ctx.guild
-    old_role = guild.get_role(OLD_ROLE_ID)
-    new_role = guild.get_role(NEW_ROLE_ID)
-    channel = bot.get_channel(CHANNEL_ID)
+    old_role = get_cached_role(guild, config.old_role_id)
+    new_role = get_cached_role(guild, config.new_role_id)
+    channel = get_cached_channel()
     if not old_role or not new_role or not channel:
         logging.error("Role or channel not found.")
         return False
     return True
 
 
-async def handle_command(ctx, threshold: int = JOIN_TIME_THRESHOLD):
+async def handle_command(ctx, threshold: int = config.join_time_threshold):
     """
     Handle the execution of the bot command.
 
+    Runs are serialized, so a second command waits for the first to finish
+    and then skips the members it already promoted.
+
     Args:
         ctx (commands.Context): The context of the command.
-        threshold (int, optional): The join time threshold. Defaults to JOIN_TIME_THRESHOLD.
+        threshold (int, optional): The join time threshold. Defaults to config.join_time_threshold.
     """
-    if not check_admin_role(ctx):
-        await ctx.send("У вас нет прав на выполнение этой команды.")
-        return
+    async with _command_lock:
+        if not check_roles_and_channel(ctx):
+            await ctx.send("Role or channel not found.")
+            return
+
+        guild = ctx.guild
+        old_role = get_cached_role(guild, config.old_role_id)
+        new_role = get_cached_role(guild, config.new_role_id)
+        channel = get_cached_channel()
+
+        members = await get_members_with_old_role(guild)
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            seconds=threshold
+        )
+        eligible = (
+            member
+            for member in members
+            if member.joined_at is not None
+            and member.joined_at < cutoff
+            and member.get_role(new_role.id) is None
+        )
 
-    if not check_roles_and_channel(ctx):
-        await ctx.send("Role or channel not found.")
-        return
+        async def promote(member):
+            task = get_promotion_task(member, old_role, new_role, channel)
+            if task is not None:
+                await task
 
-    guild = ctx.guild
-    old_role = guild.get_role(OLD_ROLE_ID)
-    new_role = guild.get_role(NEW_ROLE_ID)
-    channel = bot.get_channel(CHANNEL_ID)
-
-    members = await get_members_with_old_role(guild)
-    if tasks := [
-        change_role_and_send_message(member, old_role, new_role, channel)
-        for member in members
-        if check_join_time(member, threshold)
-    ]:
-        await asyncio.gather(*tasks)
-    else:
-        await ctx.send("Достойных кандидатов не нашлось, милорд.")
+        count, failed = await run_workers(eligible, promote)
+        if not count:
+            await ctx.send("Достойных кандидатов не нашлось, милорд.")
+        elif failed:
+            await ctx.send(
+                f"Не удалось повысить {len(failed)} из {count} кандидатов. Подробности в журнале."
+            )
 
 
-@bot.command()
-async def C(ctx, threshold: int = JOIN_TIME_THRESHOLD):
+@bot.command(name="c")
+@is_admin()
+async def c(ctx, threshold: int = config.join_time_threshold):
     """
-    Bot command handler for 'C'.
+    Bot command handler for 'c'. Also matches 'C', since the bot is case-insensitive.
 
     Args:
         ctx (commands.Context): The context of the command.
-        threshold (int, optional): The join time threshold. Defaults to JOIN_TIME_THRESHOLD.
+        threshold (int, optional): The join time threshold. Defaults to config.join_time_threshold.
     """
     await handle_command(ctx, threshold)
 
 
-@bot.command()
-async def c(ctx, threshold: int = JOIN_TIME_THRESHOLD):
+@bot.event
+async def on_command_error(ctx, error):
     """
-    Bot command handler for 'c'.
+    Event handler for errors raised while invoking a command.
 
     Args:
         ctx (commands.Context): The context of the command.
-        threshold (int, optional): The join time threshold. Defaults to JOIN_TIME_THRESHOLD.
+        error (commands.CommandError): The error that was raised.
     """
-    await handle_command(ctx, threshold)
+    if isinstance(error, commands.MissingRole):
+        await ctx.send("У вас нет прав на выполнение этой команды.")
+        return
+    logging.error(f"Error running command: {error}", exc_info=error)
 
 
 @bot.event
@@ -226,11 +490,114 @@ async def on_ready():
     else:
         logging.info("User is None")
 
+    global _channel
+    _channel = bot.get_channel(config.channel_id)
+
+    chunked_any = False
+    for guild in bot.guilds:
+        if not guild.chunked:
+            # Discord allows one member chunk request per guild every 30 seconds.
+            if chunked_any:
+                await asyncio.sleep(31)
+            await guild.chunk(cache=True)
+            chunked_any = True
+
+    # Rebuild the set without awaiting, so commands never see it half filled.
+    holders = {
+        member.id
+        for guild in bot.guilds
+        if get_cached_role(guild, config.old_role_id) is not None
+        for member in guild.members
+        if member.get_role(config.old_role_id) is not None
+    }
+    OLD_ROLE_MEMBERS.clear()
+    OLD_ROLE_MEMBERS.update(holders)
+    # The member cache was rebuilt, so finished promotions no longer need
+    # to wait for a member update event that may have been missed.
+    for member_id in [uid for uid, task in _inflight.items() if task.done()]:
+        del _inflight[member_id]
+
+
+@bot.event
+async def on_member_join(member):
+    """
+    Event handler for when a member joins a guild.
+
+    Args:
+        member (discord.Member): The member that joined.
+    """
+    track_old_role(member)
+
+
+@bot.event
+async def on_member_update(before, after):
+    """
+    Event handler for when a member is updated.
+
+    Args:
+        before (discord.Member): The member before the update.
+        after (discord.Member): The member after the update.
+    """
+    if before.roles != after.roles:
+        track_old_role(after)
+
+
+@bot.event
+async def on_member_remove(member):
+    """
+    Event handler for when a member leaves a guild.
+
+    Args:
+        member (discord.Member): The member that left.
+    """
+    if get_cached_role(member.guild, config.old_role_id) is not None:
+        OLD_ROLE_MEMBERS.discard(member.id)
+        _inflight.pop(member.id, None)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    """
+    Event handler for when a role is deleted.
+
+    Args:
+        role (discord.Role): The role that was deleted.
+    """
+    _role_cache.pop((role.guild.id, role.id), None)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """
+    Event handler for when a channel is deleted.
+
+    Args:
+        channel (discord.abc.GuildChannel): The channel that was deleted.
+    """
+    global _channel
+    if channel.id == config.channel_id:
+        _channel = None
+
+
+async def main():
+    """
+    Start the bot and keep it running until it is closed.
+    """
+    async with bot:
+        await bot.start(TOKEN)
+
 
 try:
     if TOKEN is None:
         raise ValueError("Token is None")
-    bot.run(TOKEN)
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 except discord.LoginFailure as e:
     logging.error(f"Failed to run bot: {e}")
     raise
+except KeyboardInterrupt:
+    pass
+finally:
+    log_listener.stop()